@@ -16,9 +16,14 @@
 #
 
 import uuid
+from typing import Iterator
 
+import ijson
+import orjson
 import requests
 
+from .session import create_session
+
 
 class Closure:
     """
@@ -29,8 +34,16 @@ class Closure:
     entries can be processed without ever having to hold the entire table in memory.
     """
 
-    def __init__(self, tx_url: str):
+    def __init__(self, tx_url: str, session: requests.Session = None):
+        """
+        :param tx_url: A FHIR terminology server endpoint.
+        :param session: A session to use for requests to the terminology server. If not supplied, a
+            new session will be created.
+        """
         self._tx_url = tx_url
+        self._session = session if session is not None else create_session()
+        # The codings that have already been added to the closure table.
+        self._seen = set()
         self._name = self._initialize()
 
     def _initialize(self):
@@ -49,20 +62,33 @@ class Closure:
                 }
             ],
         }
-        initialize_response = requests.post(
+        initialize_response = self._session.post(
             f"{self._tx_url}/$closure",
-            json=initialize_request,
-            headers={
-                "Content-Type": "application/fhir+json",
-                "Accept": "application/fhir+json",
-            },
+            data=orjson.dumps(initialize_request),
         )
         initialize_response.raise_for_status()
         return name
 
-    def update(self, codings: list[dict]) -> list[(str, str)]:
+    def update(self, codings: list[dict]) -> Iterator[tuple[str, str]]:
         # The update request adds a batch of codings to the closure table and returns the new
-        # subsumption relationships.
+        # subsumption relationships. The request is sent when iteration over the result begins.
+        #
+        # Codings that are already in the closure table are left out of the request, as the server
+        # would not report any new relationships for them. If there is nothing left to add, no
+        # request is made.
+        concepts = {}
+        for coding in codings:
+            if coding is not None:
+                concept = dict(
+                    (k, coding[k]) for k in ["system", "version", "code"] if k in coding
+                )
+                key = tuple(concept.items())
+                if key not in self._seen:
+                    concepts[key] = concept
+        if not concepts:
+            return
+        self._seen.update(concepts)
+
         update_request = {
             "resourceType": "Parameters",
             "parameter": [
@@ -73,37 +99,25 @@ class Closure:
                 [
                     {
                         "name": "concept",
-                        "valueCoding": dict(
-                            (k, coding[k])
-                            for k in ["system", "version", "code"]
-                            if k in coding
-                        ),
+                        "valueCoding": concept,
                     }
-                    for coding in codings
-                    if coding is not None
+                    for concept in concepts.values()
                 ],
             ],
         }
-        update_response = requests.post(
+        update_response = self._session.post(
             f"{self._tx_url}/$closure",
-            json=update_request,
-            headers={
-                "Content-Type": "application/fhir+json",
-                "Accept": "application/fhir+json",
-            },
+            data=orjson.dumps(update_request),
+            stream=True,
         )
         update_response.raise_for_status()
-        concept_map = update_response.json()
 
-        # Convert the concept map into a list of tuples of source codes that subsume target codes.
-        return (
-            [
-                (element["code"], target["code"])
-                for group in concept_map["group"]
-                for element in group["element"]
-                for target in element["target"]
-                if target["equivalence"] == "subsumes"
-            ]
-            if "group" in concept_map
-            else []
-        )
+        # Walk the elements of the concept map as they are streamed back from the server, rather
+        # than loading the whole response into memory. Each element yields tuples of its source
+        # code and the target codes that it subsumes.
+        with update_response:
+            update_response.raw.decode_content = True
+            for element in ijson.items(update_response.raw, "group.item.element.item"):
+                for target in element["target"]:
+                    if target["equivalence"] == "subsumes":
+                        yield element["code"], target["code"]
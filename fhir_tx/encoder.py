@@ -15,15 +15,32 @@
 #     limitations under the License.
 #
 
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator
+
 import numpy as np
 import numpy.typing as npt
+import orjson
+import pandas as pd
 import requests
-from scipy.sparse import csr_matrix, hstack, lil_matrix
+from requests_cache import CachedSession
+from scipy.sparse import csr_matrix, hstack, load_npz, save_npz
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.preprocessing import OneHotEncoder
+from sklearn.feature_extraction import DictVectorizer, FeatureHasher
 
 from .closure import Closure
+from .session import create_session
+
+log = logging.getLogger(__name__)
 
 EXPANSION_PROPERTY_PREADOPT = (
     "http://hl7.org/fhir/5.0/StructureDefinition/"
@@ -32,6 +49,23 @@ EXPANSION_PROPERTY_PREADOPT = (
 
 IGNORED_PROPERTIES = ["parent", "child"]
 
+# The names of the value[x] elements that can hold the value of a property.
+VALUE_KEYS = (
+    "valueCode",
+    "valueCoding",
+    "valueString",
+    "valueInteger",
+    "valueBoolean",
+    "valueDateTime",
+    "valueDecimal",
+)
+
+# The number of pages of an expansion that are requested from the terminology server at once.
+EXPANSION_WORKERS = 8
+
+# The number of subsumption pairs that are translated into matrix coordinates at a time.
+CLOSURE_CHUNK_SIZE = 65536
+
 
 class FhirTerminologyEncoder(BaseEstimator, TransformerMixin):
     """
@@ -41,6 +75,11 @@ class FhirTerminologyEncoder(BaseEstimator, TransformerMixin):
     Currently this is limited to subsumption relationships as reported by the closure operation of
     the terminology server.
 
+    The encodings are returned as sparse matrices of ``uint8``, as they are made up of 0s and 1s.
+    The exception is when a property has a numeric value, in which case the ``float64`` type of
+    the property encoding is kept. Cast the result (e.g. ``.astype(np.float32)``) if a floating
+    point result is needed from downstream arithmetic.
+
     :ivar codes_: The list of codes that are included in the scope, in the order that they are
         represented within the columns of the encoding.
     :type codes_: list[str]
@@ -56,6 +95,11 @@ class FhirTerminologyEncoder(BaseEstimator, TransformerMixin):
         subsumption: bool = True,
         properties: list[str] = None,
         batch_size: int = 50000,
+        closure_batch_size: int = 100000,
+        property_features: int = None,
+        expansion_cache: str = None,
+        use_cache: bool = False,
+        cache_dir: str = "~/.cache/fhir_tx",
     ):
         """
         :param scope: A FHIR ValueSet URI that defines the scope of the codes to be encoded.
@@ -63,137 +107,351 @@ class FhirTerminologyEncoder(BaseEstimator, TransformerMixin):
         :param subsumption: Whether to include subsumption relationships in the encoding.
         :param properties: A list of properties to include in the encoding. A single value of "*"
             will include all properties.
-        :param batch_size: The number of codes to send to the terminology server at a time when
-            running queries.
+        :param batch_size: The number of codes to retrieve from the terminology server at a time
+            when expanding the scope.
+        :param closure_batch_size: The number of codes to send to the terminology server at a time
+            when building the transitive closure. This is independent of the expansion batch size,
+            and can be set larger to make fewer closure requests.
+        :param property_features: If supplied, properties are hashed into this number of columns,
+            rather than having a column for each distinct property value. This bounds the size of
+            the encoding for properties with many distinct values, at the cost of the hashed
+            columns not having descriptive feature names.
+        :param expansion_cache: The path to a SQLite database in which to cache the pages of the
+            expansion, so that repeated encodings of the same scope do not need to retrieve it
+            from the terminology server again. If not supplied, no caching is done. When
+            use_cache is set, an encoding that is rebuilt always retrieves a fresh expansion, and
+            updates the expansion cache with it.
+        :param use_cache: Whether to save the finished encoding to disk, and to reuse it when the
+            same scope is encoded again with the same options. Cached encodings are invalidated
+            when the versions of the code systems used to expand the scope change on the server,
+            and the encoding for the previous versions is removed once the new one is saved.
+        :param cache_dir: The directory in which cached encodings are kept.
         """
-        print(f"Expanding value set: {scope}")
-        coding_batches = self._expand_scope(scope, tx_url, properties, batch_size)
-        print("Expansion complete")
-
-        print("Generating one-hot encoding...", end=" ")
-        ohe = OneHotEncoder(categories=[self.codes_])
-        # Use a lil_matrix as an intermediate representation that enables efficient updates.
-        self._encoded = lil_matrix(
-            ohe.fit_transform(np.array(self.codes_).reshape(-1, 1))
-        )
-        print(self._encoded.shape)
+        if closure_batch_size < 1:
+            raise ValueError("closure_batch_size must be a positive integer")
+
+        # A single session is shared by all requests to the terminology server, so that
+        # connections are reused across the expand and closure requests.
+        session = create_session(cache=expansion_cache)
+
+        cache_path = None
+        if use_cache:
+            cache_path = encoding_cache_path(
+                cache_dir,
+                session,
+                scope,
+                tx_url,
+                subsumption,
+                properties,
+                property_features,
+            )
+        if cache_path is not None and cache_path.with_suffix(".npz").exists():
+            log.info("Loading encoding from cache: %s", cache_path)
+            self._load_cache(cache_path)
+        else:
+            # An encoding that is saved to the cache is keyed on the versions currently on the
+            # server, so its expansion must not come from older responses in the expansion cache.
+            self._encode(
+                scope,
+                tx_url,
+                subsumption,
+                properties,
+                batch_size,
+                closure_batch_size,
+                property_features,
+                session,
+                refresh=cache_path is not None,
+            )
+            if cache_path is not None:
+                log.info("Saving encoding to cache: %s", cache_path)
+                self._save_cache(cache_path)
 
-        # Create an index of code -> index, which we use to update the correct row and column in
-        # the matrix when making subsumption updates.
-        print("Creating index...", end=" ")
-        self._index = {value: index for index, value in enumerate(ohe.categories_[0])}
-        print(f"{len(self._index)} items")
+        # A pandas index can locate a whole array of codes in a single vectorised lookup, which we
+        # use when transforming input columns.
+        self._code_index = pd.Index(self.codes_)
 
+    def _encode(
+        self,
+        scope,
+        tx_url,
+        subsumption,
+        properties,
+        batch_size,
+        closure_batch_size,
+        property_features,
+        session,
+        refresh=False,
+    ):
+        """
+        Build the encoding of the codes in the scope using the terminology server.
+        """
+        # Create an index of code -> index, which we use to find the correct row and column in the
+        # matrix when making subsumption updates. It is only needed while building the encoding,
+        # after which the pandas index of the codes takes over.
+        index = {}
+
+        log.info("Expanding value set: %s", scope)
+        coding_batches = self._expand_scope(
+            scope, tx_url, properties, batch_size, session, index, refresh
+        )
+        if subsumption:
+            # The closure is applied to each batch as it arrives, which overlaps the closure
+            # requests with the retrieval of the remaining pages of the expansion.
+            log.info("Applying transitive closure...")
+            rows, cols = self._apply_closure(
+                coding_batches, tx_url, session, closure_batch_size, index
+            )
+        else:
+            # Nothing else consumes the batches, so run the expansion to completion and discard
+            # them. The codes, displays and properties are collected as a side effect.
+            deque(coding_batches, maxlen=0)
+            # The one-hot encoding of the codes is the diagonal of the matrix.
+            rows = cols = np.arange(len(self.codes_), dtype=np.int32)
+        self._encoded = binary_csr_matrix(rows, cols, len(self.codes_))
         if subsumption:
-            print("Applying transitive closure...")
-            self._apply_closure(coding_batches, tx_url)
-            print(f"Subsumption encoding complete: {self._encoded.shape}")
+            log.info("Subsumption encoding complete: %s", self._encoded.shape)
+        else:
+            log.info("Generated one-hot encoding: %s", self._encoded.shape)
 
         self.feature_names_ = self.codes_
         if properties is not None:
-            print("Encoding properties...", end=" ")
-            dv = DictVectorizer()
-            encoded_properties = dv.fit_transform(self.properties_)
-            self._encoded = hstack([self._encoded, encoded_properties])
-            print(self._encoded.shape)
-            self.feature_names_ = self.feature_names_ + dv.feature_names_
+            if property_features is not None:
+                # Hash the properties in a single pass, without building a vocabulary.
+                fh = FeatureHasher(
+                    n_features=property_features,
+                    input_type="dict",
+                    alternate_sign=False,
+                )
+                encoded_properties = fh.transform(self.properties_)
+                property_names = [
+                    f"property_hash_{i}" for i in range(property_features)
+                ]
+            else:
+                dv = DictVectorizer()
+                encoded_properties = dv.fit_transform(self.properties_)
+                property_names = dv.feature_names_
+            encoded_properties = to_compact_dtype(encoded_properties)
+            # Stack straight into a csr_matrix, for efficient arithmetic operations.
+            self._encoded = hstack([self._encoded, encoded_properties], format="csr")
+            log.info("Encoded properties: %s", self._encoded.shape)
+            self.feature_names_ = self.feature_names_ + property_names
+
+    def _save_cache(self, cache_path: Path):
+        """
+        Save the encoding and the fitted attributes to the cache.
+        """
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        attributes = {
+            "codes_": self.codes_,
+            "displays_": self.displays_,
+            "properties_": self.properties_,
+            "feature_names_": self.feature_names_,
+        }
+        write_atomically(
+            cache_path.with_suffix(".pkl"), lambda f: pickle.dump(attributes, f)
+        )
+        # The matrix is written last, as its presence is what marks the cache entry as complete.
+        write_atomically(
+            cache_path.with_suffix(".npz"), lambda f: save_npz(f, self._encoded)
+        )
+
+        # Remove the encodings of the same scope and options for other versions of the
+        # terminology, which will not be used again. The matrix of each is removed first, so that
+        # an entry is never left looking complete without its attributes.
+        options_digest = cache_path.name.split("-")[0]
+        for suffix in (".npz", ".pkl"):
+            for path in cache_path.parent.glob(f"{options_digest}-*{suffix}"):
+                if path.stem != cache_path.name:
+                    path.unlink(missing_ok=True)
 
-        # Convert the final product back to a csr_matrix for efficient arithmetic operations.
-        self._encoded = self._encoded.tocsr()
+    def _load_cache(self, cache_path: Path):
+        """
+        Load the encoding and the fitted attributes from the cache.
+        """
+        with open(cache_path.with_suffix(".pkl"), "rb") as f:
+            for name, value in pickle.load(f).items():
+                setattr(self, name, value)
+        self._encoded = load_npz(cache_path.with_suffix(".npz"))
 
-    def _expand_scope(self, scope, tx_url, properties, batch_size):
+    def _expand_scope(
+        self, scope, tx_url, properties, batch_size, session, index, refresh
+    ):
         """
-        Get the list of all codes in the scope.
+        Get the list of all codes in the scope, yielding each batch of codings as it is retrieved.
+
+        Once the first page has revealed the total number of codes, the following pages are
+        requested concurrently in the background while the caller processes the current batch.
+        The batches are still yielded in order, and each code is added to the index as it arrives.
+        The total number of codes reported by the server is recorded once the first page arrives.
         """
-        offset = 0
-        total = 0
         self.codes_ = []
         self.displays_ = []
         self.properties_ = []
-        coding_batches = []
+        self._expansion_total = 0
 
-        # Run an expand request with a count equal to the batch size, and iterate until we have
+        # Run expand requests with a count equal to the batch size, and iterate until we have
         # retrieved all codes.
-        while offset <= total:
-            params = {
-                "url": scope,
-                "count": batch_size,
-                "offset": offset,
-            }
-            params = [
-                ("url", scope),
-                ("count", batch_size),
-                ("offset", offset),
-            ]
-            if properties is not None:
-                for p in properties:
-                    params.append(("property", p))
-            response = requests.get(
-                f"{tx_url}/ValueSet/$expand",
-                params=params,
-            )
-            response.raise_for_status()
-            response_json = response.json()
-            total = response_json["expansion"]["total"]
-
-            print(
-                f"Expanding ({len(response_json['expansion']['contains'])} items, offset {offset}, "
-                f"total {total})"
-            )
-            codings = response_json["expansion"]["contains"]
-
-            # Add the batch of codings to the list of batches. These same batches will be used later
-            # in the closure operation.
-            coding_batches.append(codings)
-
-            # Add each code and display to a list. These are useful for later retrieval for the
-            # creation of feature name dictionaries.
-            self.codes_.extend([coding["code"] for coding in codings])
-            self.displays_.extend(
-                [
-                    (coding["display"] if "display" in coding else None)
-                    for coding in codings
-                ]
-            )
-            if properties is not None:
-                self.properties_.extend(
-                    [properties_to_dict(coding) for coding in codings]
+        fetch_page = partial(
+            expand_page, session, tx_url, scope, properties, batch_size, refresh=refresh
+        )
+        with ThreadPoolExecutor(max_workers=EXPANSION_WORKERS) as executor:
+            pending = deque([(0, executor.submit(fetch_page, 0))])
+            next_offset = batch_size
+            while pending:
+                offset, page = pending.popleft()
+                response_json = page.result()
+                total = response_json["expansion"]["total"]
+                self._expansion_total = total
+                codings = response_json["expansion"].get("contains", [])
+                log.info(
+                    "Expanding (%d items, offset %d, total %d)",
+                    len(codings),
+                    offset,
+                    total,
                 )
 
-            # The offset of the next query is the current offset plus the batch size.
-            offset += batch_size
+                # Keep up to one page per worker in flight before processing this one. The window
+                # is bounded so that pages do not pile up in memory if the caller is slower than
+                # the server.
+                while next_offset < total and len(pending) < EXPANSION_WORKERS:
+                    pending.append(
+                        (next_offset, executor.submit(fetch_page, next_offset))
+                    )
+                    next_offset += batch_size
 
-        return coding_batches
+                # Add each code and display to a list. These are useful for later retrieval for
+                # the creation of feature name dictionaries.
+                codes = [coding["code"] for coding in codings]
+                index.update(
+                    (code, len(self.codes_) + i) for i, code in enumerate(codes)
+                )
+                # Each code needs a row and column of its own, so a code that appears more than once
+                # in the expansion cannot be encoded.
+                if len(index) < len(self.codes_) + len(codes):
+                    duplicate = next(
+                        code
+                        for code, count in Counter(self.codes_ + codes).items()
+                        if count > 1
+                    )
+                    raise ValueError(
+                        f"Expansion contains duplicate code: {duplicate!r}"
+                    )
+                self.codes_.extend(codes)
+                self.displays_.extend(
+                    [
+                        (coding["display"] if "display" in coding else None)
+                        for coding in codings
+                    ]
+                )
+                if properties is not None:
+                    self.properties_.extend(
+                        [properties_to_dict(coding) for coding in codings]
+                    )
+
+                # Pass the batch of codings on to the caller. These same batches are used in the
+                # closure operation.
+                yield codings
+        log.info("Expansion complete")
 
-    def _apply_closure(self, coding_batches, tx_url):
+    def _apply_closure(
+        self, coding_batches, tx_url, session, closure_batch_size, index
+    ):
         """
-        Perform a closure operation on all the codes in the scope and update the encoded matrix with
-        the subsumption relationships.
+        Perform a closure operation on all the codes in the scope and return the coordinates of
+        the 1s in the encoding matrix, as arrays of rows and columns. These are the subsumption
+        relationships between the codes, followed by the diagonal of the one-hot encoding.
         """
-        closure = Closure(tx_url=tx_url)
-        num_batches = len(coding_batches)
+        closure = Closure(tx_url=tx_url, session=session)
+        # The coordinates of each relationship are written into integer arrays, which are sized by
+        # the first batch and grown as later batches fill them up.
+        rows = np.empty(0, dtype=np.int32)
+        cols = np.empty(0, dtype=np.int32)
+        num_rows = 0
+
+        def to_indices(codes):
+            # Translate codes into positions within the matrix, iterating over the index in C
+            # rather than in a Python loop.
+            return np.fromiter(
+                map(index.__getitem__, codes), dtype=np.int32, count=len(codes)
+            )
 
-        for i, batch in enumerate(coding_batches):
-            print(f"Batch {i + 1} of {num_batches}, {len(batch)} items...", end=" ")
-            # Get the new pairs that result from adding a batch of codes to the closure table.
+        def update(batch):
+            # Add a batch of codes to the closure table, and translate the new pairs into x and y
+            # coordinates in the matrix in chunks as they are streamed back from the server.
+            batch_rows = []
+            batch_cols = []
             pairs = closure.update(batch)
-            for pair in pairs:
-                # Use the index to find the correct x and y coordinates in the matrix.
-                x = self._index[pair[0]]
-                y = self._index[pair[1]]
-                # Update the matrix with the new subsumption relationship.
-                self._encoded[x, y] = 1
-            print(f"{len(pairs)} pairs added")
+            while chunk := list(islice(pairs, CLOSURE_CHUNK_SIZE)):
+                sources, targets = zip(*chunk)
+                batch_rows.append(to_indices(sources))
+                batch_cols.append(to_indices(targets))
+            return batch_rows, batch_cols
+
+        def add_pairs(batch_number, batch_size, pending):
+            nonlocal rows, cols, num_rows
+            batch_rows, batch_cols = pending.result()
+            num_pairs = sum(len(chunk) for chunk in batch_rows)
+            if num_rows + num_pairs > len(rows):
+                # Grow geometrically, so that the arrays only need to be reallocated a few times.
+                # Room is also left for the diagonal of every code in the expansion, so that the
+                # arrays do not need to be grown again to add it once the last batch is in.
+                capacity = max(
+                    2 * len(rows), num_rows + num_pairs + self._expansion_total
+                )
+                rows = grow(rows, num_rows, capacity)
+                cols = grow(cols, num_rows, capacity)
+            for chunk_rows, chunk_cols in zip(batch_rows, batch_cols):
+                rows[num_rows : num_rows + len(chunk_rows)] = chunk_rows
+                cols[num_rows : num_rows + len(chunk_cols)] = chunk_cols
+                num_rows += len(chunk_rows)
+            log.info(
+                "Batch %d: %d items, %d pairs added",
+                batch_number,
+                batch_size,
+                num_pairs,
+            )
+
+        # Each update only returns the relationships that are new to the closure table, so the
+        # updates must reach the server one at a time and in order. A single worker preserves this,
+        # while the next batch of the expansion is retrieved and the pairs from the previous update
+        # are gathered.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            previous = None
+            # Regroup the batches of the expansion into batches of the closure batch size.
+            for i, batch in enumerate(rebatch(coding_batches, closure_batch_size)):
+                pending = executor.submit(update, batch)
+                if previous is not None:
+                    add_pairs(*previous)
+                previous = (i + 1, len(batch), pending)
+            if previous is not None:
+                add_pairs(*previous)
+
+        # Write the diagonal into the tail of the same arrays, so that the whole matrix can be
+        # built from them without another copy of every pair. The arrays only lack room for it if
+        # no pairs were returned at all, or if the expansion held more codes than its reported
+        # total.
+        n = len(self.codes_)
+        if num_rows + n > len(rows):
+            rows = grow(rows, num_rows, num_rows + n)
+            cols = grow(cols, num_rows, num_rows + n)
+        rows[num_rows : num_rows + n] = cols[num_rows : num_rows + n] = np.arange(n)
+        return rows[: num_rows + n], cols[: num_rows + n]
+
+    def _locate(self, codes: npt.NDArray) -> npt.NDArray:
+        """
+        Find the rows of the encoded matrix that correspond to an array of codes.
+        """
+        indices = self._code_index.get_indexer(codes)
+        missing = np.flatnonzero(indices == -1)
+        if missing.size:
+            raise ValueError(f"Encountered code not in scope: {codes[missing[0]]!r}")
+        return indices
 
     def transform_column(self, X: npt.NDArray) -> csr_matrix:
         """
         Retrieve the encodings for a single column of codes.
         """
-        try:
-            X_indices = np.array([self._index[x] for x in X])
-        except KeyError as e:
-            raise ValueError(f"Encountered code not in scope: {e}")
-        return self._encoded[X_indices]
+        return self._encoded[self._locate(np.asarray(X))]
 
     def transform(self, X: npt.NDArray[npt.NDArray]) -> csr_matrix:
         """
@@ -204,8 +462,27 @@ class FhirTerminologyEncoder(BaseEstimator, TransformerMixin):
         if len(X.shape) != 2:
             raise ValueError("X must be a two-dimensional array")
 
-        stacked = hstack([self.transform_column(X[:, y]) for y in range(X.shape[1])])
-        return stacked
+        # Look up all the codes at once, and gather the encoding of every cell of the input with a
+        # single fancy index. Row i * n_cols + j of the gathered matrix is the encoding of X[i, j].
+        n_rows, n_cols = X.shape
+        gathered = self._encoded[self._locate(X.ravel())]
+
+        # Each row of the result is made up of n_cols consecutive rows of the gathered matrix, laid
+        # side by side. So the result can be built from the gathered arrays directly: the row
+        # pointers are every n_cols-th pointer of the gathered matrix, and the column indices of
+        # each cell are shifted across to the block of columns for its input column.
+        width = self._encoded.shape[1]
+        column_offsets = np.repeat(
+            np.tile(np.arange(n_cols) * width, n_rows), np.diff(gathered.indptr)
+        )
+        return csr_matrix(
+            (
+                gathered.data,
+                gathered.indices + column_offsets,
+                gathered.indptr[::n_cols],
+            ),
+            shape=(n_rows, n_cols * width),
+        )
 
     def fit(self, X, y=None):
         """
@@ -214,45 +491,179 @@ class FhirTerminologyEncoder(BaseEstimator, TransformerMixin):
         return self
 
 
-def properties_to_dict(coding: dict):
+def grow(array: npt.NDArray, size: int, capacity: int) -> npt.NDArray:
+    """
+    Copy the first size elements of an array into a new, larger array with the given capacity.
+    """
+    grown = np.empty(capacity, dtype=array.dtype)
+    grown[:size] = array[:size]
+    return grown
+
+
+def binary_csr_matrix(rows: npt.NDArray, cols: npt.NDArray, n: int) -> csr_matrix:
+    """
+    Build an n x n matrix with a 1 at each of the given coordinates. Repeated coordinates are
+    collapsed, so every value in the matrix is 0 or 1.
+    """
+    # Encode each coordinate as a single integer key. Sorting and deduplicating the keys puts the
+    # coordinates in row-major order, which is the layout of a CSR matrix, so the matrix can be
+    # assembled from them directly rather than converted from another format.
+    keys = np.unique(rows.astype(np.int64) * n + cols)
+    indices = (keys % n).astype(np.int32)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // n, minlength=n), out=indptr[1:])
+    return csr_matrix(
+        (np.ones(len(keys), dtype=np.uint8), indices, indptr), shape=(n, n)
+    )
+
+
+def to_compact_dtype(matrix):
+    """
+    Convert a sparse matrix to uint8 if it only contains 0s and 1s, so that it takes up an eighth
+    of the memory of the float64 matrix. Matrices with any other values are returned unchanged.
+    """
+    if np.isin(matrix.data, (0, 1)).all():
+        return matrix.astype(np.uint8)
+    return matrix
+
+
+def encoding_cache_path(
+    cache_dir: str,
+    session: requests.Session,
+    scope: str,
+    tx_url: str,
+    subsumption: bool,
+    properties: list[str],
+    property_features: int,
+) -> Path:
+    """
+    Get the path, without a suffix, at which the encoding of a scope is cached.
+
+    The name is made up of a digest of the options that affect the encoding, followed by a digest
+    of the versions of the value set and code systems that the server uses to expand the scope. An
+    encoding is therefore rebuilt when the terminology on the server is updated, and the encodings
+    for earlier versions can be found by their shared options digest.
+    """
+    # The versions must come from the server itself. A response from the expansion cache could be
+    # older than a terminology update, which would then go unnoticed.
+    response_json = expand_page(session, tx_url, scope, None, 0, 0, refresh=True)
+    expansion = response_json["expansion"]
+    versions = [
+        parameter
+        for parameter in expansion.get("parameter", [])
+        if parameter["name"] in ("version", "used-codesystem", "used-valueset")
+    ]
+    options_key = orjson.dumps(
+        [tx_url, scope, subsumption, properties, property_features]
+    )
+    versions_key = orjson.dumps(
+        [response_json.get("version"), expansion["total"], versions]
+    )
+    name = "-".join(
+        hashlib.sha256(key).hexdigest() for key in (options_key, versions_key)
+    )
+    return Path(cache_dir).expanduser() / name
+
+
+def write_atomically(path: Path, write: Callable[[BinaryIO], None]):
+    """
+    Write a file by passing a temporary file to the write function, and then moving it into place.
+    An interrupted write therefore never leaves behind a partial file at the path.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
     try:
-        result = {}
-        if "property" in coding:
-            for property_element in coding["property"]:
-                code = property_element["code"]
-                if code not in IGNORED_PROPERTIES:
-                    value_key = next(k for k in coding.keys() if k.startswith("value"))
-                    result[code] = property_element[value_key]
-                    add_subproperties_to_dict(property_element, code, result)
-        elif "extension" in coding:
-            property_extensions = [
-                e
-                for e in coding["extension"]
-                if e["url"] == EXPANSION_PROPERTY_PREADOPT
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def rebatch(batches: Iterable[list], size: int) -> Iterator[list]:
+    """
+    Regroup an iterable of batches into batches of the given size. The last batch may be smaller.
+    """
+    buffer = []
+    for batch in batches:
+        # Walk through the batch with a cursor, topping up the partial batch left over from the
+        # previous one, so that each item is only copied once.
+        start = 0
+        while len(buffer) + len(batch) - start >= size:
+            end = start + size - len(buffer)
+            yield buffer + batch[start:end]
+            buffer = []
+            start = end
+        buffer.extend(batch[start:])
+    if buffer:
+        yield buffer
+
+
+def expand_page(
+    session: requests.Session,
+    tx_url: str,
+    scope: str,
+    properties: list[str],
+    count: int,
+    offset: int,
+    refresh: bool = False,
+) -> dict:
+    """
+    Retrieve a single page of the expansion of a value set.
+
+    If refresh is set and the session has an expansion cache, the page is always requested from the
+    server, and replaces any response held in the cache.
+    """
+    params = [
+        ("url", scope),
+        ("count", count),
+        ("offset", offset),
+    ]
+    if properties is not None:
+        for p in properties:
+            params.append(("property", p))
+    url = f"{tx_url}/ValueSet/$expand"
+    if refresh and isinstance(session, CachedSession):
+        # Evict the cached response, rather than using force_refresh. That sends a no-cache
+        # directive on to the server, which would also bypass any cache in front of it.
+        session.cache.delete(
+            requests=[
+                session.prepare_request(requests.Request("GET", url, params=params))
             ]
-            for property_extension in property_extensions:
-                code_extension = next(
-                    e for e in property_extension["extension"] if e["url"] == "code"
-                )
-                code = code_extension["valueCode"]
-                if code not in IGNORED_PROPERTIES:
-                    value_extension = next(
-                        (
-                            e
-                            for e in property_extension["extension"]
-                            if e["url"] == "value"
-                        ),
-                        None,
-                    )
-                    if value_extension is not None:
-                        value_key = next(
-                            k for k in value_extension.keys() if k.startswith("value")
-                        )
-                        result[code] = value_extension[value_key]
-                    add_subproperties_to_dict(property_extension, code, result)
-
-    except StopIteration:
-        return {}
+        )
+    response = session.get(url, params=params)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+def properties_to_dict(coding: dict):
+    result = {}
+    if "property" in coding:
+        for property_element in coding["property"]:
+            code = property_element["code"]
+            if code not in IGNORED_PROPERTIES:
+                value_key = find_value_key(property_element)
+                if value_key is None:
+                    return {}
+                result[code] = property_element[value_key]
+                add_subproperties_to_dict(property_element, code, result)
+    elif "extension" in coding:
+        property_extensions = [
+            e for e in coding["extension"] if e["url"] == EXPANSION_PROPERTY_PREADOPT
+        ]
+        for property_extension in property_extensions:
+            extensions = index_extensions(property_extension)
+            if "code" not in extensions:
+                return {}
+            code = extensions["code"]["valueCode"]
+            if code not in IGNORED_PROPERTIES:
+                value_extension = extensions.get("value")
+                if value_extension is not None:
+                    value_key = find_value_key(value_extension)
+                    if value_key is None:
+                        return {}
+                    result[code] = value_extension[value_key]
+                add_subproperties_to_dict(property_extension, code, result)
     return result
 
 
@@ -261,22 +672,36 @@ def add_subproperties_to_dict(property_element: dict, code: str, result: dict):
         subproperty_extensions = [
             e for e in property_element["extension"] if e["url"] == "subproperty"
         ]
-        try:
-            for subproperty_extension in subproperty_extensions:
-                code_extension = next(
-                    e for e in subproperty_extension["extension"] if e["url"] == "code"
-                )
-                subcode = f"{code}.{code_extension['valueCode']}"
-                if subcode not in IGNORED_PROPERTIES:
-                    value_extension = next(
-                        e
-                        for e in subproperty_extension["extension"]
-                        if e["url"] == "value"
-                    )
-                    value_key = next(
-                        k for k in value_extension.keys() if k.startswith("value")
-                    )
-                    result[subcode] = value_extension[value_key]
-                    add_subproperties_to_dict(subproperty_extension, subcode, result)
-        except StopIteration:
-            return
+        for subproperty_extension in subproperty_extensions:
+            extensions = index_extensions(subproperty_extension)
+            if "code" not in extensions:
+                return
+            subcode = f"{code}.{extensions['code']['valueCode']}"
+            if subcode not in IGNORED_PROPERTIES:
+                value_extension = extensions.get("value")
+                if value_extension is None:
+                    return
+                value_key = find_value_key(value_extension)
+                if value_key is None:
+                    return
+                result[subcode] = value_extension[value_key]
+                add_subproperties_to_dict(subproperty_extension, subcode, result)
+
+
+def index_extensions(element: dict) -> dict:
+    """
+    Index the extensions of an element by their URL, so that each one can be retrieved with a
+    single lookup. Where a URL is repeated, the first extension with that URL is kept.
+    """
+    return {e["url"]: e for e in reversed(element["extension"])}
+
+
+def find_value_key(element: dict):
+    """
+    Find the name of the value[x] element that holds the value of a property, or None if there is
+    no value.
+    """
+    for key in VALUE_KEYS:
+        if key in element:
+            return key
+    return None
@@ -0,0 +1,92 @@
+#
+#     Copyright © 2023 Commonwealth Scientific and Industrial Research Organisation (CSIRO)
+#     ABN 41 687 119 230.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util import Retry
+
+# How long a cached expansion is reused before it is requested from the server again.
+CACHE_EXPIRY = timedelta(days=7)
+
+# Statuses that indicate a busy or temporarily unavailable server, which are worth retrying.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Statuses that indicate that the server did not process the request at all.
+NOT_PROCESSED_STATUSES = (429, 503)
+
+
+class TerminologyServerRetry(Retry):
+    """
+    Retries GET requests when the server is busy or unavailable, but only retries POST requests
+    when the server indicates that the request was not processed.
+
+    A closure update that was applied before a gateway error was returned would not report its
+    relationships a second time, so retrying it would silently lose them.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return status_code in NOT_PROCESSED_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def create_session(cache: str = None) -> requests.Session:
+    """
+    Creates a session for talking to a FHIR terminology server.
+
+    The session keeps connections alive between requests, so that the many expand and closure
+    requests made while building an encoding do not each pay for a new TCP and TLS handshake. It
+    also retries requests that fail because the server is temporarily busy.
+
+    :param cache: The path to a SQLite database in which to cache the responses to GET requests,
+        such as expansions. Closure requests are never cached, as they update state on the
+        server. If not supplied, no caching is done.
+    """
+    session = (
+        CachedSession(
+            cache,
+            backend="sqlite",
+            expire_after=CACHE_EXPIRY,
+            allowable_methods=("GET",),
+        )
+        if cache is not None
+        else requests.Session()
+    )
+    # Transient failures are retried with exponential backoff, honouring any Retry-After header
+    # sent by the server. Once the retries are exhausted, the last response is returned so that it
+    # can be raised as an error by the caller.
+    retry = TerminologyServerRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(
+        {
+            "Content-Type": "application/fhir+json",
+            "Accept": "application/fhir+json",
+        }
+    )
+    return session
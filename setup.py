@@ -35,6 +35,9 @@ setup(
         "pandas~=2.1.2",
         "scipy~=1.11.3",
         "requests~=2.31.0",
+        "requests-cache~=1.1.1",
+        "orjson~=3.9.10",
+        "ijson~=3.2.3",
         "scikit-learn~=1.3.2",
     ],
     python_requires=">=3.9",